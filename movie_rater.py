@@ -1,19 +1,50 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
+from gspread.utils import rowcol_to_a1
 from google.oauth2.service_account import Credentials
 import random
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- Google Sheets Setup ---
 scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-skey = st.secrets["gcp_service_account"]
-credentials = Credentials.from_service_account_info(skey, scopes=scopes)
-client = gspread.authorize(credentials)
-url = st.secrets["private_gsheets_url"]
 sheet_name = "Movies"   # 👈 your Movies sheet
-worksheet = client.open_by_url(url).worksheet(sheet_name)
+write_timeout = 15      # seconds a vote waits on an earlier sheet write
+
+@st.cache_resource
+def get_worksheet():
+    # Authorize and open the sheet once; gspread handles aren't picklable, so keep one shared instance
+    skey = st.secrets["gcp_service_account"]
+    credentials = Credentials.from_service_account_info(skey, scopes=scopes)
+    client = gspread.authorize(credentials)
+    url = st.secrets["private_gsheets_url"]
+    return client.open_by_url(url).worksheet(sheet_name)
+
+worksheet = get_worksheet()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_column_indices():
+    # Header row -> column index, refreshed on the same schedule as load_movies
+    hdr = worksheet.row_values(1)
+    if not hdr:
+        # Raising keeps an empty header out of the cache
+        raise ValueError("Movies sheet has no header row")
+    return {h.strip().lower(): i for i, h in enumerate(hdr)}
+
+@st.cache_resource
+def get_executor():
+    # Sheet writes run here so a vote doesn't wait on the Sheets API
+    return ThreadPoolExecutor(max_workers=2)
+
+# --- Helper: Genre Overlap ---
+def get_genre_set(genres_str):
+    if isinstance(genres_str, str):
+        return frozenset(g.strip().lower() for g in genres_str.split(",") if g.strip())
+    return frozenset()
 
 # --- Load and Clean Data ---
+@st.cache_data(ttl=300, show_spinner=False)
 def load_movies():
     data = worksheet.get_all_records()
 
@@ -32,166 +63,239 @@ def load_movies():
     # ✅ Ensure required columns exist
     if "elo" not in df_movies.columns:
         df_movies["elo"] = 1500
+    if "poster_url" not in df_movies.columns:
+        df_movies["poster_url"] = ""
+
+    # ✅ Cast string fields (skip the cast when the column is already all strings)
+    for col in ["Title", "director", "poster_url", "genres"]:
+        values = df_movies[col]
+        if pd.api.types.infer_dtype(values, skipna=False) != "string":
+            values = values.astype(str)
+        df_movies[col] = values.str.strip()
+    df_movies["_has_poster"] = df_movies["poster_url"].str.startswith("http", na=False)
+
+    # ✅ Lowercased Title and parsed genres for matching, computed once per load
+    # Arrow-backed so lowercasing and the Title match on a vote use vectorized kernels
+    df_movies["_title_lc"] = df_movies["Title"].astype("string[pyarrow]").str.lower()
+    df_movies["_genre_set"] = df_movies["genres"].map(get_genre_set)
+
+    # ✅ Ensure elo is numeric; the sheet usually hands back ints already
+    elo = df_movies["elo"]
+    if pd.api.types.is_integer_dtype(elo):
+        elo = elo.astype(np.int32)
+    else:
+        elo = pd.to_numeric(elo, errors="coerce").fillna(1500).astype(np.int32)
+    df_movies["elo"] = elo
 
-    # ✅ Cast string fields
-    df_movies["Title"] = df_movies["Title"].astype(str).str.strip()
-    df_movies["director"] = df_movies["director"].astype(str).str.strip()
-    df_movies["poster_url"] = df_movies.get("poster_url", "").astype(str).str.strip()
-    df_movies["genres"] = df_movies["genres"].astype(str).str.strip()
-
-    # ✅ Ensure elo is numeric
-    df_movies["elo"] = pd.to_numeric(df_movies["elo"], errors="coerce").fillna(1500).astype(int)
+    # ✅ Remember each row's position in the sheet (row 1 is the header)
+    df_movies["_sheet_row"] = np.arange(2, len(df_movies) + 2)
 
     return df_movies
 
-df_movies = load_movies()
+# --- Background Sheet Writes ---
+if "pending_writes" not in st.session_state:
+    st.session_state.pending_writes = []
+if "write_errors" not in st.session_state:
+    st.session_state.write_errors = []
+if "pending_elo" not in st.session_state:
+    st.session_state.pending_elo = {}  # future -> {lowercase Title: new Elo}
+
+def collect_finished_writes(wait_for_all=False):
+    # Keep errors from finished writes for the UI and drop cached data they made stale
+    pending = st.session_state.pending_writes
+    if wait_for_all:
+        # Bounded, since a hung Sheets request would otherwise block the script forever
+        wait(pending, timeout=write_timeout)
+    finished = [f for f in pending if f.done()]
+    for f in finished:
+        st.session_state.pending_elo.pop(f, None)
+        if f.exception():
+            st.session_state.write_errors.append(f"❌ Update failed: {f.exception()}")
+    if finished:
+        load_movies.clear()
+    st.session_state.pending_writes = [f for f in pending if not f.done()]
+    return bool(finished)
+
+def apply_pending_elo(df):
+    # Show Elo from writes still in flight, so the page doesn't lag a vote behind
+    for updates in st.session_state.pending_elo.values():
+        for title_lc, elo in updates.items():
+            df.loc[df["_title_lc"] == title_lc, "elo"] = elo
+    return df
+
+collect_finished_writes()
+
+df_movies = apply_pending_elo(load_movies())
+ALL_GENRES = sorted({g for gs in df_movies["_genre_set"] for g in gs})
 
 # --- Helper: Safe Image Display ---
-def safe_image(url, caption=None):
-    if isinstance(url, str) and url.strip().startswith("http"):
-        st.image(url.strip(), width="stretch", caption=caption)
+def safe_image(url, has_poster, caption=None):
+    if has_poster:
+        st.image(url, width="stretch", caption=caption)
     else:
         st.write("🎞️ No poster available")
         if caption:
             st.write(caption)
 
-# --- Helper: Genre Overlap ---
-def get_genre_set(genres_str):
-    if isinstance(genres_str, str):
-        return set(g.strip().lower() for g in genres_str.split(",") if g.strip())
-    return set()
-
-def sample_movie_pair(df):
-    # Try up to 50 times to find a valid pair
-    for _ in range(50):
-        pair = df.sample(2).reset_index(drop=True)
-        g1 = get_genre_set(pair.iloc[0]["genres"])
-        g2 = get_genre_set(pair.iloc[1]["genres"])
-        if g1 & g2:  # non-empty intersection
-            return pair
-    # Fallback: just return any two
-    return df.sample(2).reset_index(drop=True)
+# --- Helper: Genre Lookups ---
+def build_genre_mask(df, genres):
+    # rows × genres boolean matrix, so filtering by genre is just a column lookup
+    return pd.DataFrame(
+        {g: df["_genre_set"].map(lambda gs, g=g: g in gs).to_numpy(dtype=bool) for g in genres},
+        index=df.index,
+    )
+
+def build_genre_index(genre_mask):
+    # genre -> row labels of every movie in that genre (only genres with a possible pair)
+    index = {g: genre_mask.index[genre_mask[g].to_numpy()].to_numpy() for g in genre_mask.columns}
+    return {g: rows for g, rows in index.items() if len(rows) >= 2}
+
+def sample_movie_pair(df, genre_index):
+    # Returns (row label, lowercase Title) for each movie; the rows themselves stay in the cached DataFrame
+    if genre_index:
+        # Pick a genre weighted by size, then two movies from it
+        g = random.choices(list(genre_index), weights=[len(v) for v in genre_index.values()])[0]
+        i, j = np.random.choice(genre_index[g], size=2, replace=False)
+    else:
+        # Fallback: just return any two
+        i, j = np.random.choice(df.index, size=2, replace=False)
+    return tuple((int(k), df.at[k, "_title_lc"]) for k in (i, j))
+
+def pair_is_current(df, pair):
+    # Labels are sheet positions, so they only still point at the same movies if the titles match
+    return all(i in df.index and df.at[i, "_title_lc"] == title_lc for i, title_lc in pair)
+
+genre_index = build_genre_index(build_genre_mask(df_movies, ALL_GENRES))
+
+# --- Elo Update Function ---
+def update_elo(winner_elo: int, loser_elo: int, k=32) -> tuple[int, int]:
+    expected_win = 1.0 / (1.0 + 10.0 ** ((loser_elo - winner_elo) * 0.0025))  # 0.0025 == 1/400
+    new_winner_elo = winner_elo + k * (1 - expected_win)
+    new_loser_elo = loser_elo - k * (1 - expected_win)
+    # Plain ints so the values serialize cleanly in the Sheets request
+    return int(round(new_winner_elo)), int(round(new_loser_elo))
+
+# --- Process Vote and Update Sheet ---
+# Runs before any UI so a vote reruns straight away without rendering the old pair
+if "vote" not in st.session_state:
+    st.session_state.vote = None
+
+if st.session_state.vote:
+    # ✅ Let earlier writes land first so this vote starts from current Elo
+    if collect_finished_writes(wait_for_all=True):
+        df_movies = apply_pending_elo(load_movies())
+    (winner_idx, winner_lc), (loser_idx, loser_lc) = st.session_state.vote
+
+    if st.session_state.pending_writes:
+        # ✅ An earlier write is still running, so this vote can't start from current Elo
+        st.session_state.write_errors.append("❌ Vote not saved: the previous vote is still saving. Please try again.")
+    elif not pair_is_current(df_movies, st.session_state.vote):
+        # ✅ The rows moved since this pair was shown, so don't write Elo onto other movies
+        st.session_state.write_errors.append("❌ Vote not saved: the sheet changed since this pair was shown.")
+    else:
+        new_winner_elo, new_loser_elo = update_elo(
+            int(df_movies.at[winner_idx, "elo"]), int(df_movies.at[loser_idx, "elo"])
+        )
+
+        # ✅ Sheet rows are already known from load_movies, no need to re-read the sheet
+        elo_col = get_column_indices()["elo"] + 1
+        winner_rows = df_movies.loc[df_movies["_title_lc"] == winner_lc, "_sheet_row"].tolist()
+        loser_rows = df_movies.loc[df_movies["_title_lc"] == loser_lc, "_sheet_row"].tolist()
+
+        # Update all rows in sheet with same Title in one request, off the script thread
+        updates = (
+            [{"range": rowcol_to_a1(i, elo_col), "values": [[new_winner_elo]]} for i in winner_rows]
+            + [{"range": rowcol_to_a1(i, elo_col), "values": [[new_loser_elo]]} for i in loser_rows]
+        )
+        if updates:
+            future = get_executor().submit(worksheet.batch_update, updates, value_input_option="USER_ENTERED")
+            st.session_state.pending_writes.append(future)
+            st.session_state.pending_elo[future] = {winner_lc: new_winner_elo, loser_lc: new_loser_elo}
+
+        st.success(f"You voted for **{df_movies.at[winner_idx, 'Title'].title()}**!")
+
+    # Reset and rerun; finished writes clear the cache so later pairs get fresh Elo
+    st.session_state.vote = None
+    del st.session_state.movie_pair
+    st.rerun()
 
 # --- App UI ---
 st.title("🎬 Movie Rater")
 st.write("Choose your favorite between two movies. Elo scores will update based on your vote.")
 
+# Shown here rather than when collected, so a vote's rerun doesn't wipe them
+for msg in st.session_state.write_errors:
+    st.error(msg)
+st.session_state.write_errors = []
+
 # --- Random Movie Pair ---
-if "movie_pair" not in st.session_state:
-    st.session_state.movie_pair = sample_movie_pair(df_movies)
+# Redraw if there's no pair yet or its rows no longer hold the same movies after a reload
+if "movie_pair" not in st.session_state or not pair_is_current(df_movies, st.session_state.movie_pair):
+    st.session_state.movie_pair = sample_movie_pair(df_movies, genre_index)
 
-movie1, movie2 = st.session_state.movie_pair.iloc[0], st.session_state.movie_pair.iloc[1]
+entry1, entry2 = st.session_state.movie_pair
+movie1, movie2 = df_movies.loc[entry1[0]], df_movies.loc[entry2[0]]
 
 # --- Show Shared Genres Above ---
-shared_genres = get_genre_set(movie1["genres"]) & get_genre_set(movie2["genres"])
+shared_genres = movie1["_genre_set"] & movie2["_genre_set"]
 if shared_genres:
     st.write(f"🎭 These two are being compared in the **{', '.join(sorted(shared_genres)).title()}** genre(s).")
 else:
     st.write("🎭 These two movies don’t share a genre (fallback pairing).")
 
 # --- Voting Buttons ---
-if "vote" not in st.session_state:
-    st.session_state.vote = None
+def cast_vote(winner, loser):
+    # Form callbacks run before the rerun, so the vote is handled above
+    st.session_state.vote = (winner, loser)
 
-col1, col2 = st.columns(2)
+with st.form("vote_form", border=False):
+    col1, col2 = st.columns(2)
 
-with col1:
-    safe_image(movie1["poster_url"], f"{movie1['Title'].title()} (Dir. {movie1['director']})")
-    if st.button(f"Vote: {movie1['Title'].title()}"):
-        st.session_state.vote = (movie1, movie2)
+    with col1:
+        safe_image(movie1["poster_url"], movie1["_has_poster"], f"{movie1['Title'].title()} (Dir. {movie1['director']})")
+        st.form_submit_button(f"Vote: {movie1['Title'].title()}", key="vote1", on_click=cast_vote, args=(entry1, entry2))
 
-with col2:
-    safe_image(movie2["poster_url"], f"{movie2['Title'].title()} (Dir. {movie2['director']})")
-    if st.button(f"Vote: {movie2['Title'].title()}"):
-        st.session_state.vote = (movie2, movie1)
+    with col2:
+        safe_image(movie2["poster_url"], movie2["_has_poster"], f"{movie2['Title'].title()} (Dir. {movie2['director']})")
+        st.form_submit_button(f"Vote: {movie2['Title'].title()}", key="vote2", on_click=cast_vote, args=(entry2, entry1))
 
 # --- Skip Button ---
 if st.button("🔄 Skip this pair"):
-    st.session_state.movie_pair = sample_movie_pair(df_movies)
-    st.rerun()
-
-# --- Elo Update Function ---
-def update_elo(winner_elo, loser_elo, k=32):
-    expected_win = 1 / (1 + 10 ** ((loser_elo - winner_elo) / 400))
-    new_winner_elo = winner_elo + k * (1 - expected_win)
-    new_loser_elo = loser_elo - k * (1 - expected_win)
-    return round(new_winner_elo), round(new_loser_elo)
-
-# --- Process Vote and Update Sheet ---
-if st.session_state.vote:
-    winner, loser = st.session_state.vote
-    new_winner_elo, new_loser_elo = update_elo(winner["elo"], loser["elo"])
-
-    # ✅ Update Elo for all rows with same Title
-    df_movies.loc[df_movies["Title"].str.lower() == winner["Title"].lower(), "elo"] = new_winner_elo
-    df_movies.loc[df_movies["Title"].str.lower() == loser["Title"].lower(), "elo"] = new_loser_elo
-
-    sheet_data = worksheet.get_all_values()
-    headers = [h.strip().lower() for h in sheet_data[0]]
-    title_idx = headers.index("title")
-    elo_idx = headers.index("elo")
-
-    try:
-        # Update all rows in sheet with same Title
-        for i, row in enumerate(sheet_data[1:], start=2):
-            row_title = row[title_idx].strip().lower()
-            if row_title == winner["Title"].strip().lower():
-                worksheet.update_cell(i, elo_idx + 1, new_winner_elo)
-            if row_title == loser["Title"].strip().lower():
-                worksheet.update_cell(i, elo_idx + 1, new_loser_elo)
-
-        st.success(f"You voted for **{winner['Title'].title()}**! Elo updated.")
-    except Exception as e:
-        st.error(f"❌ Update failed: {e}")
-
-    # Reset and rerun
-    st.session_state.vote = None
-    st.session_state.movie_pair = sample_movie_pair(df_movies)
+    st.session_state.movie_pair = sample_movie_pair(df_movies, genre_index)
     st.rerun()
 
 # --- Leaderboard ---
 st.subheader("🏆 Leaderboard")
 
 # Create genre filter options
-all_genres = set()
-for g in df_movies["genres"].dropna():
-    for genre in g.split(","):
-        genre = genre.strip()
-        if genre:
-            all_genres.add(genre)
-
-genre_options = ["Overall"] + sorted(all_genres)
-selected_genre = st.selectbox("Filter leaderboard by genre:", genre_options)
+genre_options = ["Overall"] + ALL_GENRES
+selected_genre = st.selectbox("Filter leaderboard by genre:", genre_options, format_func=str.title)
 
 # ✅ Aggregate leaderboard by Title so duplicates collapse
-if selected_genre == "Overall":
-    leaderboard_df = (
-        df_movies.groupby("Title", as_index=False)
-        .first()[["Title","director","genres","elo"]]
-        .sort_values("elo", ascending=False)
+@st.cache_data(ttl=300, max_entries=4, show_spinner=False)
+def build_leaderboard(df):
+    # Sort once, then keep the first row per Title (stable sort keeps sheet order among ties)
+    return (
+        df.sort_values("elo", ascending=False, kind="stable")
+        .drop_duplicates(subset="Title", keep="first")[["Title","director","genres","elo","poster_url","_has_poster","_genre_set"]]
     )
+
+leaderboard = build_leaderboard(df_movies)
+leaderboard_genre_mask = build_genre_mask(leaderboard, ALL_GENRES)
+
+if selected_genre == "Overall":
+    leaderboard_df = leaderboard[["Title","director","genres","elo"]]
 else:
-    mask = df_movies["genres"].str.contains(selected_genre, case=False, na=False)
-    leaderboard_df = (
-        df_movies[mask]
-        .groupby("Title", as_index=False)
-        .first()[["Title","director","genres","elo"]]
-        .sort_values("elo", ascending=False)
-    )
+    leaderboard_df = leaderboard.loc[leaderboard_genre_mask[selected_genre], ["Title","director","genres","elo"]]
 
 st.dataframe(leaderboard_df, use_container_width=True, hide_index=True)
 
 # --- Top Movie in Each Genre ---
-def get_top_movies_by_genre(df):
+def get_top_movies_by_genre(leaderboard, genre_mask):
+    # leaderboard is already deduped by Title and sorted by Elo
     top_movies = []
-    for g in sorted(set(genre.strip() for gs in df["genres"].dropna() for genre in gs.split(","))):
-        mask = df["genres"].str.contains(g, case=False, na=False)
-        genre_df = (
-            df[mask]
-            .groupby("Title", as_index=False)
-            .first()
-            .sort_values("elo", ascending=False)
-        )
+    for g in genre_mask.columns:
+        genre_df = leaderboard[genre_mask[g]]
         if not genre_df.empty:
             top_movies.append((g, genre_df.iloc[0]))
     return top_movies
@@ -199,10 +303,10 @@ def get_top_movies_by_genre(df):
 
 st.subheader("🎞️ Top Movie in Each Genre")
 
-top_movies = get_top_movies_by_genre(df_movies)
+top_movies = get_top_movies_by_genre(leaderboard, leaderboard_genre_mask)
 
 # Build a horizontal scroll container
-scroll_html = "<div style='display:flex; overflow-x:auto; gap:20px; padding:10px;'>"
+parts = ["<div style='display:flex; overflow-x:auto; gap:20px; padding:10px;'>"]
 
 for genre, movie in top_movies:
     poster = movie["poster_url"]
@@ -210,15 +314,16 @@ for genre, movie in top_movies:
     director = movie["director"]
     elo = movie["elo"]
 
-    if poster and poster.startswith("http"):
-        scroll_html += (
+    if movie["_has_poster"]:
+        parts.append(
             f"<div style='flex:0 0 auto; text-align:center;'>"
             f"<img src='{poster}' style='height:250px; border-radius:8px;'>"
-            f"<div><b>{title}</b><br>({genre})<br>Dir. {director}<br>Elo: {elo}</div>"
+            f"<div><b>{title}</b><br>({genre.title()})<br>Dir. {director}<br>Elo: {elo}</div>"
             f"</div>"
         )
 
-scroll_html += "</div>"
+parts.append("</div>")
+scroll_html = "".join(parts)
 
 # ✅ Render as HTML
 st.markdown(scroll_html, unsafe_allow_html=True)